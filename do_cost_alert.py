@@ -1,12 +1,39 @@
 #!/usr/bin/env python3
+import argparse
+import hashlib
+import itertools
+import json
 import os
+import re
+import shelve
 import sys
-from datetime import datetime, timedelta
+import time
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-import digitalocean
-from tabulate import tabulate
-import requests
-import requests.exceptions
+
+API_BASE_URL = "https://api.digitalocean.com"
+BILLING_HISTORY_PATH = "/v2/customers/my/billing_history"
+BALANCE_PATH = "/v2/customers/my/balance"
+PER_PAGE = 200
+
+MAX_RETRIES = 5
+BACKOFF_FACTOR = 0.5  # seconds; doubles on every retry
+RETRY_STATUSES = {429, 502, 503, 504}
+MAX_RETRY_DELAY = 60  # seconds; caps Retry-After so a run can't stall
+
+CACHE_DIR = Path.home() / ".cache" / "do-cost-alert"
+CACHE_TTL = 3600  # seconds
+
+_DAILY_HEADER = "| Description | Amount ($) | Duration |\n|---|---:|---|\n"
+_DAILY_ROW = "| {} | {:>8.2f} | {} |\n"
+_DAILY_TOTAL = "| **Total** | **{:.2f}** |  |"
+
+_SUMMARY_HEADER = "| Day | Cost ($) | Running Total ($) |\n|----:|---------:|------------------:|\n"
+_SUMMARY_ROW = "| {} | {:.2f} | {:.2f} |\n"
+
+# Matches "| <day> | <cost> |" rows; header and separator rows never match.
+# Only used to seed state.json from summaries written by older versions.
+_ROW_RE = re.compile(rb'^\|\s*(\d+)\s*\|\s*\$?([\d.,]+)\s*\|', re.M)
 
 class DigitalOceanError(Exception):
     """Base exception class for DigitalOcean API errors."""
@@ -20,80 +47,276 @@ class APIError(DigitalOceanError):
     """Exception raised for DigitalOcean API issues."""
     pass
 
+class _RetryTransport:
+    """Transport that retries rate-limited and 5xx responses with backoff.
+
+    Implements the httpx transport interface by duck typing so httpx is
+    only imported once a client is actually created.
+    """
+
+    def __init__(self, transport, retries=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR):
+        self._transport = transport
+        self._retries = retries
+        self._backoff_factor = backoff_factor
+
+    @staticmethod
+    def _retry_after(response):
+        """Return the Retry-After delay in seconds, or None if absent/invalid."""
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        if value.isdigit():
+            return float(value)
+        import email.utils
+        
+        try:
+            retry_at = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if retry_at.tzinfo is None:
+            # "-0000" dates parse as naive but are defined as UTC
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        return max(0.0, retry_at.timestamp() - time.time())
+
+    async def handle_async_request(self, request):
+        import asyncio
+        
+        for attempt in range(self._retries + 1):
+            response = await self._transport.handle_async_request(request)
+            if response.status_code not in RETRY_STATUSES or attempt == self._retries:
+                return response
+            delay = self._retry_after(response)
+            if delay is None:
+                delay = self._backoff_factor * (2 ** attempt)
+            delay = min(delay, MAX_RETRY_DELAY)
+            await response.aclose()
+            await asyncio.sleep(delay)
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+    async def __aenter__(self):
+        await self._transport.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._transport.__aexit__(*exc_info)
+
+def _env_proxy(url):
+    """Return the proxy URL the environment configures for url, if any.
+
+    httpx ignores HTTPS_PROXY/ALL_PROXY/NO_PROXY once a custom transport is
+    passed in, so they are resolved here instead.
+    """
+    import urllib.parse
+    import urllib.request
+    
+    if urllib.request.proxy_bypass(urllib.parse.urlsplit(url).hostname):
+        return None
+    proxies = urllib.request.getproxies()
+    return proxies.get('https') or proxies.get('all')
+
 def get_do_manager():
-    """Initialize DigitalOcean manager with API token."""
+    """Create an HTTP/2 DigitalOcean API client for DO_TOKEN.
+
+    The caller owns the client and should use it as an async context
+    manager so every request in a run shares one connection.
+    """
     token = os.getenv('DO_TOKEN')
     if not token:
         raise TokenError("DigitalOcean API token not found. Please set DO_TOKEN environment variable.")
     
+    # Imported lazily so --help and the missing-token path start quickly
+    import httpx
+    
+    # Connection-level retries cover network errors; _RetryTransport
+    # covers 429/5xx responses. The pool is large enough for paginated
+    # fetches to run without waiting on each other.
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        proxy=_env_proxy(API_BASE_URL),
+        retries=MAX_RETRIES,
+        limits=httpx.Limits(max_connections=10, max_keepalive_connections=10)
+    )
+    client = httpx.AsyncClient(
+        transport=_RetryTransport(transport),
+        base_url=API_BASE_URL,
+        headers={
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json"
+        },
+        timeout=httpx.Timeout(15.0)
+    )
+    return token, client
+
+async def _get_json(client, path, params=None):
+    """GET a DigitalOcean API path and return the decoded JSON body."""
+    response = await client.get(path, params=params)
+    response.raise_for_status()
+    return response.json()
+
+async def verify_token(client):
+    """Verify the API token with a lightweight balance request."""
+    import httpx
+    
     try:
-        manager = digitalocean.Manager(token=token)
-        # Verify token by making a simple API call
-        manager.get_account()
-        return token, manager
-    except requests.exceptions.HTTPError as e:
+        await _get_json(client, BALANCE_PATH)
+    except httpx.HTTPStatusError as e:
         if e.response.status_code == 401:
             raise TokenError("Invalid DigitalOcean API token. Please check your token and try again.")
         raise APIError(f"HTTP Error: {str(e)}")
-    except requests.exceptions.ConnectionError:
+    except httpx.ConnectError:
         raise APIError("Connection error. Please check your internet connection.")
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         raise APIError("Request timed out. Please try again later.")
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         raise APIError(f"An error occurred while connecting to DigitalOcean: {str(e)}")
     except Exception as e:
         raise APIError(f"Unexpected error: {str(e)}")
 
-def get_billing_history(token):
-    """Fetch billing history from DigitalOcean API."""
+def _cache_key(token, today_str):
+    """Build the billing cache key without storing the raw token."""
+    token_hash = hashlib.blake2b(token.encode()).hexdigest()[:16]
+    return f"{token_hash}:{today_str}:billing"
+
+def _read_cache(key):
+    """Return a cached billing entry, or None if missing or unreadable."""
+    try:
+        with shelve.open(str(CACHE_DIR / "billing"), flag='r') as cache:
+            return cache.get(key)
+    except Exception:  # dbm errors, corrupt pickles; it's only a cache
+        return None
+
+def _write_cache(key, entry):
+    """Store a billing entry and drop entries for other days.
+
+    Cache failures never break a run.
+    """
+    today_str = key.split(':')[1]
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with shelve.open(str(CACHE_DIR / "billing")) as cache:
+            for stale_key in [k for k in cache.keys() if k.split(':')[1:2] != [today_str]]:
+                del cache[stale_key]
+            cache[key] = entry
+    except Exception:  # dbm errors, corrupt pickles; it's only a cache
+        pass
+
+class _AsyncByteReader:
+    """Async file-like view of a streamed httpx response, as ijson expects."""
+
+    def __init__(self, response):
+        self._chunks = response.aiter_bytes()
+
+    async def read(self, size=-1):
+        # ijson probes with read(0) to tell bytes from text; don't consume a chunk
+        if size == 0:
+            return b''
+        try:
+            return await self._chunks.__anext__()
+        except StopAsyncIteration:
+            return b''
+
+async def get_billing_history(client, token, now):
+    """Stream today's billing history entries from DigitalOcean API.
+
+    Only today's entries are kept. DigitalOcean lists entries newest first;
+    once consecutive entries confirm that order, parsing stops at the first
+    entry older than today and later pages are never requested. If the
+    order can't be confirmed, every page is read.
+
+    Results are cached on disk for CACHE_TTL seconds. Once an entry goes
+    stale it is revalidated with If-None-Match, and a 304 extends it.
+    """
+    import httpx
+    import ijson
+    
     try:
         # Get today's date and first day of current month
-        today = datetime.now()
-        start_of_month = today.replace(day=1).strftime('%Y-%m-%d')
-        today_str = today.strftime('%Y-%m-%d')
+        start_of_month = now.replace(day=1).strftime('%Y-%m-%d')
+        today_str = now.strftime('%Y-%m-%d')
+
+        key = _cache_key(token, today_str)
+        cached = _read_cache(key)
+        if cached and time.time() - cached['ts'] < CACHE_TTL:
+            return cached['billing_history']
 
-        url = "https://api.digitalocean.com/v2/customers/my/billing_history"
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
-        
         params = {
             'start_time': start_of_month,
-            'end_time': today_str
+            'end_time': today_str,
+            'per_page': PER_PAGE
         }
         
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
+        headers = {}
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
         
-        billing_data = response.json()
-        return billing_data.get('billing_history', [])
+        billing_history = []
+        etag = None
+        prev_date = None
+        newest_first = None  # unknown until two entries differ in date
+        page = 1
+        while True:
+            async with client.stream(
+                'GET',
+                BILLING_HISTORY_PATH,
+                params={**params, 'page': page},
+                headers=headers if page == 1 else {}
+            ) as response:
+                if response.status_code == 304:
+                    cached['ts'] = time.time()
+                    _write_cache(key, cached)
+                    return cached['billing_history']
+                response.raise_for_status()
+                if page == 1:
+                    etag = response.headers.get('ETag')
+                
+                page_items = 0
+                reached_older = False
+                async for item in ijson.items(_AsyncByteReader(response), 'billing_history.item'):
+                    page_items += 1
+                    date_str = item['date'][:10]
+                    if newest_first is None and prev_date is not None and date_str != prev_date:
+                        newest_first = date_str < prev_date
+                    prev_date = date_str
+                    if date_str == today_str:
+                        billing_history.append(item)
+                    elif date_str < today_str and newest_first:
+                        reached_older = True
+                        break
+            
+            if reached_older or page_items < PER_PAGE:
+                break
+            page += 1
+        
+        _write_cache(key, {
+            'ts': time.time(),
+            'etag': etag,
+            'billing_history': billing_history
+        })
+        return billing_history
     
-    except requests.exceptions.HTTPError as e:
+    except httpx.HTTPStatusError as e:
         if e.response.status_code == 401:
             raise TokenError("Token authorization failed while fetching billing history.")
         elif e.response.status_code == 429:
-            raise APIError("Rate limit exceeded. Please try again later.")
+            raise APIError("Rate limit exceeded after retries. Please try again later.")
         raise APIError(f"HTTP Error while fetching billing history: {str(e)}")
+    except httpx.TimeoutException:
+        raise APIError("Request timed out while fetching billing history. Please try again later.")
     except Exception as e:
         raise APIError(f"Error fetching billing history: {str(e)}")
 
-def calculate_daily_cost(billing_history):
-    """Calculate the cost for the current day."""
-    today = datetime.now().date()
+def calculate_daily_cost(billing_history, now):
+    """Calculate the cost for now's day as (description, amount, duration) tuples."""
+    today_str = now.strftime('%Y-%m-%d')
     daily_costs = []
     
     for item in billing_history:
-        # Handle both date formats: '2025-02-16' and '2025-02-16T13:15:26Z'
-        date_str = item['date'].split('T')[0] if 'T' in item['date'] else item['date']
-        date = datetime.strptime(date_str, '%Y-%m-%d').date()
-        
-        if date == today and item.get('amount', '0') != '0':
-            daily_costs.append({
-                'description': item['description'],
-                'amount': float(item['amount']),
-                'duration': 'N/A'
-            })
+        # Both '2025-02-16' and '2025-02-16T13:15:26Z' start with the ISO date,
+        # so a prefix comparison avoids parsing every entry
+        if item['date'][:10] == today_str and item.get('amount', '0') != '0':
+            daily_costs.append((item['description'], float(item['amount']), 'N/A'))
     
     return daily_costs
 
@@ -102,124 +325,179 @@ def create_markdown_table(daily_costs):
     if not daily_costs:
         return "No costs recorded for today.", 0
     
-    headers = ["Description", "Amount ($)", "Duration"]
-    table_data = [
-        [item['description'], f"{item['amount']:.2f}", item['duration']]
-        for item in daily_costs
-    ]
+    total_cost = sum(amount for _, amount, _ in daily_costs)
+    table = _DAILY_HEADER + ''.join(
+        _DAILY_ROW.format(*item) for item in daily_costs
+    ) + _DAILY_TOTAL.format(total_cost)
     
-    total_cost = sum(item['amount'] for item in daily_costs)
-    table_data.append(["**Total**", f"**{total_cost:.2f}**", ""])
-    
-    return tabulate(table_data, headers=headers, tablefmt="pipe"), total_cost
+    return table, total_cost
 
-def update_monthly_summary(daily_costs, total_cost):
-    """Update the monthly summary table."""
-    now = datetime.now()
-    year_dir = Path(str(now.year))
-    month_dir = year_dir / f"{now.month:02d}"
-    summary_file = month_dir / "monthly_summary.md"
+def _month_dir(now):
+    """Return the YYYY/MM directory for now, creating it if needed."""
+    month_dir = Path(str(now.year)) / f"{now.month:02d}"
+    month_dir.mkdir(parents=True, exist_ok=True)
+    return month_dir
+
+def _orjson():
+    """Return orjson if installed, or None to fall back to the json module.
+
+    Imported lazily like httpx so --help and the missing-token path skip it.
+    """
+    try:
+        import orjson
+    except ImportError:  # optional, only speeds up the monthly state file
+        return None
+    return orjson
+
+def _load_month(month_dir, existing_files):
+    """Load the {day: cost} state for a month directory."""
+    state_file = month_dir / "state.json"
+    if "state.json" in existing_files:
+        data = state_file.read_bytes()
+        orjson = _orjson()
+        state = orjson.loads(data) if orjson else json.loads(data)
+        return {int(day): cost for day, cost in state.items()}
     
-    # Initialize monthly data structure
+    # Seed from a summary written before state.json existed
     monthly_data = {}
+    if "monthly_summary.md" in existing_files:
+        content = (month_dir / "monthly_summary.md").read_bytes()
+        for day, cost in _ROW_RE.findall(content):
+            try:
+                monthly_data[int(day)] = float(cost.replace(b',', b''))
+            except ValueError:
+                continue
+    return monthly_data
+
+def _save_month(month_dir, monthly_data):
+    """Persist the {day: cost} state for a month directory."""
+    orjson = _orjson()
+    if orjson:
+        data = orjson.dumps(monthly_data, option=orjson.OPT_NON_STR_KEYS)
+    else:
+        data = json.dumps(monthly_data).encode()
     
-    # Read existing monthly summary if it exists
-    if summary_file.exists():
-        with open(summary_file, 'r') as f:
-            content = f.read()
-            # Skip header and find the table content
-            if '|' in content:
-                lines = [line.strip() for line in content.split('\n') if '|' in line]
-                # Skip header and separator lines
-                for line in lines[2:]:
-                    if '|' in line:
-                        cols = [col.strip() for col in line.split('|')[1:-1]]
-                        if len(cols) >= 2:
-                            try:
-                                day = int(cols[0])
-                                cost = float(cols[1].replace('$', '').replace(',', ''))
-                                monthly_data[day] = cost
-                            except (ValueError, IndexError):
-                                continue
+    # Write a sibling temp file and swap it in, so a run that dies mid-write
+    # can never leave a truncated state.json behind
+    tmp_file = month_dir / "state.json.tmp"
+    tmp_file.write_bytes(data)
+    os.replace(tmp_file, month_dir / "state.json")
+
+def update_monthly_summary(now, month_dir, daily_costs, total_cost, existing_files=None):
+    """Update the monthly state and regenerate the summary table from it.
 
+    existing_files is the set of names already in month_dir; it is listed
+    here when the caller doesn't pass one.
+    """
+    summary_file = month_dir / "monthly_summary.md"
+    if existing_files is None:
+        with os.scandir(month_dir) as entries:
+            existing_files = {entry.name for entry in entries}
+    
+    # state.json is the source of truth; the markdown is only a rendered view
+    monthly_data = _load_month(month_dir, existing_files)
+    
     # Update today's cost
     monthly_data[now.day] = total_cost
+    _save_month(month_dir, monthly_data)
     
-    # Create the monthly summary table
-    headers = ["Day", "Cost ($)", "Running Total ($)"]
-    table_data = []
-    running_total = 0
-    
-    for day in range(1, 32):  # Support all possible days in a month
-        if day in monthly_data:
-            running_total += monthly_data[day]
-            table_data.append([
-                str(day),
-                f"{monthly_data[day]:.2f}",
-                f"{running_total:.2f}"
-            ])
-    
-    monthly_table = tabulate(table_data, headers=headers, tablefmt="pipe")
-    
-    # Save the monthly summary
-    with open(summary_file, 'w') as f:
-        f.write(f"# DigitalOcean Cost Summary - {now.strftime('%B %Y')}\n\n")
-        f.write(monthly_table)
-        f.write("\n\n")
-        f.write(f"*Last Updated: {now.strftime('%Y-%m-%d %H:%M:%S')}*\n")
-
-def save_daily_file(content, is_error=False):
-    """Save content to a daily markdown file."""
-    now = datetime.now()
-    year_dir = Path(str(now.year))
-    month_dir = year_dir / f"{now.month:02d}"
-    
-    # Create directories if they don't exist
-    month_dir.mkdir(parents=True, exist_ok=True)
+    # Create the monthly summary table with running totals
+    days = sorted(monthly_data)
+    costs = [monthly_data[day] for day in days]
+    totals = itertools.accumulate(costs)
+    monthly_table = _SUMMARY_HEADER + ''.join(
+        _SUMMARY_ROW.format(day, cost, total)
+        for day, cost, total in zip(days, costs, totals)
+    )
     
+    # Save the monthly summary in a single write
+    summary_file.write_text(
+        f"# DigitalOcean Cost Summary - {now:%B %Y}\n\n"
+        f"{monthly_table}\n"
+        f"*Last Updated: {now:%Y-%m-%d %H:%M:%S}*\n"
+    )
+
+def save_daily_file(now, month_dir, content, is_error=False):
+    """Save content to a daily markdown file."""
     # Create the daily markdown file
     file_path = month_dir / f"{now.day:02d}.md"
     
     # If file exists and we're reporting an error, append to it
     if is_error and file_path.exists():
-        with open(file_path, 'a') as f:
-            f.write("\n\n")
-            f.write("---\n\n")  # Add separator
-            f.write(content)
+        with open(file_path, 'a', buffering=65536) as f:
+            f.write("\n\n---\n\n" + content)  # Separator and report in one write
     else:
-        with open(file_path, 'w') as f:
-            f.write(content)
+        file_path.write_text(content)
 
-def save_cost_report(content, total_cost):
+def save_cost_report(now, month_dir, content, total_cost):
     """Save the cost report to a markdown file."""
-    now = datetime.now()
-    report_content = f"# DigitalOcean Cost Report - {now.strftime('%Y-%m-%d')}\n\n"
-    report_content += content
-    report_content += f"\n\n*Generated at: {now.strftime('%Y-%m-%d %H:%M:%S')}*\n"
+    report_content = (
+        f"# DigitalOcean Cost Report - {now:%Y-%m-%d}\n\n"
+        f"{content}\n\n"
+        f"*Generated at: {now:%Y-%m-%d %H:%M:%S}*\n"
+    )
     
-    save_daily_file(report_content)
+    save_daily_file(now, month_dir, report_content)
 
 def save_error_report(error):
     """Save error information to the daily file."""
     now = datetime.now()
-    error_content = f"# DigitalOcean Error Report - {now.strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-    error_content += "```\n"
-    error_content += f"Error Type: {type(error).__name__}\n"
-    error_content += f"Error Message: {str(error)}\n"
-    error_content += "```\n"
-    error_content += f"\n*Error recorded at: {now.strftime('%Y-%m-%d %H:%M:%S')}*\n"
+    error_content = (
+        f"# DigitalOcean Error Report - {now:%Y-%m-%d %H:%M:%S}\n\n"
+        "```\n"
+        f"Error Type: {type(error).__name__}\n"
+        f"Error Message: {str(error)}\n"
+        "```\n"
+        f"\n*Error recorded at: {now:%Y-%m-%d %H:%M:%S}*\n"
+    )
+    
+    save_daily_file(now, _month_dir(now), error_content, is_error=True)
+
+def write_reports(now, markdown_table, daily_costs, total_cost):
+    """Write the daily report and monthly summary for a single timestamp."""
+    month_dir = _month_dir(now)
+    # One directory listing answers every existence check for this month
+    with os.scandir(month_dir) as entries:
+        existing_files = {entry.name for entry in entries}
     
-    save_daily_file(error_content, is_error=True)
+    save_cost_report(now, month_dir, markdown_table, total_cost)
+    update_monthly_summary(now, month_dir, daily_costs, total_cost, existing_files)
+
+async def _amain(token, client, verify=False):
+    """Fetch billing data and write the daily and monthly reports."""
+    # One timestamp for the whole run, so the fetch, the daily filter and
+    # the report files all agree on the day even if the run crosses midnight
+    now = datetime.now()
+    async with client:
+        # The billing request already reports a bad token as a 401, so the
+        # separate token check only runs when explicitly requested
+        if verify:
+            await verify_token(client)
+        billing_history = await get_billing_history(client, token, now)
+    
+    daily_costs = calculate_daily_cost(billing_history, now)
+    markdown_table, total_cost = create_markdown_table(daily_costs)
+    write_reports(now, markdown_table, daily_costs, total_cost)
+
+def parse_args():
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser(description="Generate DigitalOcean daily cost reports.")
+    parser.add_argument(
+        '--verify-token',
+        action='store_true',
+        help="validate DO_TOKEN with a separate API call before fetching billing (debugging)"
+    )
+    return parser.parse_args()
 
 def main():
     """Main function to run the cost alert script."""
+    args = parse_args()
     try:
-        token, manager = get_do_manager()
-        billing_history = get_billing_history(token)
-        daily_costs = calculate_daily_cost(billing_history)
-        markdown_table, total_cost = create_markdown_table(daily_costs)
-        save_cost_report(markdown_table, total_cost)
-        update_monthly_summary(daily_costs, total_cost)
+        token, client = get_do_manager()
+        # Imported only once there is work to do, so --help and the
+        # missing-token error never pay for asyncio
+        import asyncio
+        asyncio.run(_amain(token, client, verify=args.verify_token))
         print("Cost report generated successfully!")
     except TokenError as e:
         error_msg = f"Token Error: {str(e)}"
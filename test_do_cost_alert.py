@@ -0,0 +1,152 @@
+import asyncio
+import email.utils
+import time
+from datetime import datetime
+
+import httpx
+import pytest
+
+import do_cost_alert
+
+NOW = datetime(2025, 2, 16, 8, 0, 0)
+TODAY = "2025-02-16"
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """Keep the billing cache out of the real home directory."""
+    monkeypatch.setattr(do_cost_alert, "CACHE_DIR", tmp_path / "cache")
+    return tmp_path / "cache"
+
+
+def make_client(handler, retries=do_cost_alert.MAX_RETRIES):
+    """Build a client that sends requests to handler through _RetryTransport."""
+    transport = do_cost_alert._RetryTransport(
+        httpx.MockTransport(handler), retries=retries, backoff_factor=0
+    )
+    return httpx.AsyncClient(transport=transport, base_url=do_cost_alert.API_BASE_URL)
+
+
+def fetch(handler, **kwargs):
+    """Run get_billing_history against handler and return its result."""
+    async def run():
+        async with make_client(handler, **kwargs) as client:
+            return await do_cost_alert.get_billing_history(client, "token", NOW)
+    return asyncio.run(run())
+
+
+def entry(date, description="Droplet", amount="10.00"):
+    return {"date": date, "description": description, "amount": amount}
+
+
+def chunked(body, size=7):
+    """Yield body in small pieces so ijson has to read across chunks."""
+    async def stream():
+        for i in range(0, len(body), size):
+            yield body[i:i + size]
+    return stream()
+
+
+def test_streams_todays_entries_across_chunks():
+    items = [entry(f"{TODAY}T01:00:00Z"), entry(TODAY, "Spaces", "5.00"), entry("2025-02-15")]
+    body = httpx.Response(200, json={"billing_history": items}).content
+
+    history = fetch(lambda request: httpx.Response(200, content=chunked(body)))
+
+    assert [item["description"] for item in history] == ["Droplet", "Spaces"]
+
+
+def test_stops_at_older_entries_when_newest_first():
+    pages = []
+    items = [entry(TODAY), entry("2025-02-15"), entry("2025-02-14")]
+    items += [entry("2025-02-01")] * (do_cost_alert.PER_PAGE - len(items))
+
+    def handler(request):
+        pages.append(request.url.params["page"])
+        return httpx.Response(200, json={"billing_history": items})
+
+    history = fetch(handler)
+
+    assert len(history) == 1
+    assert pages == ["1"]
+
+
+def test_reads_every_page_when_oldest_first():
+    per_page = do_cost_alert.PER_PAGE
+    first = [entry("2025-02-01")] * (per_page - 1) + [entry("2025-02-02")]
+    pages = {"1": first, "2": [entry("2025-02-15"), entry(TODAY)]}
+
+    def handler(request):
+        return httpx.Response(200, json={"billing_history": pages[request.url.params["page"]]})
+
+    history = fetch(handler)
+
+    assert [item["date"] for item in history] == [TODAY]
+
+
+def test_not_modified_extends_cached_entry():
+    calls = []
+
+    def handler(request):
+        calls.append(request.headers.get("If-None-Match"))
+        if len(calls) == 1:
+            return httpx.Response(200, json={"billing_history": [entry(TODAY)]}, headers={"ETag": '"v1"'})
+        return httpx.Response(304)
+
+    first = fetch(handler)
+    key = do_cost_alert._cache_key("token", TODAY)
+    cached = do_cost_alert._read_cache(key)
+    cached["ts"] = 0
+    do_cost_alert._write_cache(key, cached)
+
+    second = fetch(handler)
+
+    assert calls == [None, '"v1"']
+    assert second == first
+    assert do_cost_alert._read_cache(key)["ts"] > 0
+
+
+def test_retries_rate_limit_then_succeeds():
+    responses = [
+        httpx.Response(429, headers={"Retry-After": "0"}),
+        httpx.Response(503),
+        httpx.Response(200, json={"billing_history": [entry(TODAY)]}),
+    ]
+
+    history = fetch(lambda request: responses.pop(0))
+
+    assert len(history) == 1
+    assert responses == []
+
+
+def test_rate_limit_error_once_retries_are_exhausted():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(429)
+
+    with pytest.raises(do_cost_alert.APIError, match="Rate limit exceeded"):
+        fetch(handler, retries=2)
+
+    assert len(calls) == 3
+
+
+def test_retry_delays_are_capped_and_naive_dates_read_as_utc(monkeypatch):
+    delays = []
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(asyncio, "sleep", fake_sleep)
+    in_30s = email.utils.formatdate(time.time() + 30).replace("+0000", "-0000")
+    responses = [
+        httpx.Response(429, headers={"Retry-After": "3600"}),
+        httpx.Response(429, headers={"Retry-After": in_30s}),
+        httpx.Response(200, json={"billing_history": []}),
+    ]
+
+    fetch(lambda request: responses.pop(0))
+
+    assert delays[0] == do_cost_alert.MAX_RETRY_DELAY
+    assert 25 < delays[1] <= 30